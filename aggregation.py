@@ -0,0 +1,167 @@
+import json
+
+import pandas as pd
+
+import instrumentation
+
+# Names that are missing from pycountry or are too long to fit nicely on the charts
+COUNTRY_NAME_OVERRIDES = {
+    'A1': 'Anonymous',
+    'EU': 'Europe',
+    'RU': 'Russia',
+    'MD': 'Moldova',
+    'KR': 'South Korea',
+    'IR': 'Iran',
+    'GB': 'U.K.',
+    'US': 'U.S.',
+    }
+
+PLATFORM_LABELS = ['Linux', 'BSD', 'Other']
+# The columns that every relay is grouped by, all of the chart data comes from this one groupby
+GROUP_COLUMNS = ['Country Code', 'Platform Class', 'Version', 'Exit']
+
+
+def build_country_name_table():
+    """Make a dictionary of every country code to the name that should be shown"""
+    # Only imported when the table is built as loading its database is slow
+    import pycountry
+
+    table = {country.alpha_2: country.name for country in pycountry.countries}
+    table.update(COUNTRY_NAME_OVERRIDES)
+    return table
+
+
+def load_country_name_table(file_name='country_names.json'):
+    """Load the country code to name table, it is built and saved the first time"""
+    try:
+        with open(file_name) as file:
+            table = json.load(file)
+        # Rebuild the table if the overrides have been changed since it was saved
+        if all(table.get(code) == name for code, name in COUNTRY_NAME_OVERRIDES.items()):
+            return table
+    except (OSError, ValueError):
+        pass
+    table = build_country_name_table()
+    with open(file_name, 'w') as file:
+        json.dump(table, file, indent=4, sort_keys=True)
+    return table
+
+
+def get_name(country_code, table=None):
+    """Get the country name, unknown country codes are returned unchanged"""
+    if table is None:
+        table = load_country_name_table()
+    if isinstance(country_code, str):
+        return table.get(country_code, country_code)
+    return country_code
+
+
+def map_unique(column, function, missing=None):
+    """
+    Apply a vectorised function to only the unique values of a column.
+
+    Relay exports have a lot of rows but few distinct countries and platforms, so each value
+    is only processed once and the result is a categorical column. Missing values are
+    replaced with missing.
+    """
+    codes, uniques = pd.factorize(column)
+    values = list(function(pd.Series(uniques, dtype=object))) + [missing]
+    # The code for a missing value is -1 so it picks the last value which is missing
+    mapped = pd.Categorical(values)
+    return pd.Series(pd.Categorical.from_codes(mapped.codes[codes], mapped.categories),
+                     index=column.index, name=column.name)
+
+
+def map_country_names(country_codes, table=None):
+    """Convert a column of country codes to country names"""
+    if table is None:
+        table = load_country_name_table()
+    return map_unique(country_codes, lambda codes: [get_name(code, table) for code in codes])
+
+
+def get_versions(platforms):
+    """Get first three numbers from the tor version of every relay's platform"""
+    # Platforms look like "Tor 0.4.3.5 on Linux", anything that does not is labelled Unknown
+    versions = platforms.str.extract(r'^\S+ ([^ .]+(?:\.[^ .]+){0,2})', expand=False)
+    return versions.fillna('Unknown')
+
+
+def get_platform_classes(platforms):
+    """Classify every platform as Linux, BSD or Other"""
+    # GNU/kFreeBSD is counted as Linux because GNU is found first
+    platform = platforms.str.extract('(Linux|GNU|BSD)', expand=False)
+    return platform.map({'Linux': 'Linux', 'GNU': 'Linux', 'BSD': 'BSD'}).fillna('Other')
+
+
+def add_derived_columns(df, table=None):
+    """Add the categorical columns that the relays are grouped by"""
+    instrumentation.count('rows_processed', len(df))
+    with instrumentation.span('name_mapping'):
+        df['Country Code'] = map_country_names(df['Country Code'], table)
+    with instrumentation.span('platform_and_version'):
+        df['Platform Class'] = map_unique(df['Platform'], get_platform_classes, missing='Other')
+        df['Version'] = map_unique(df['Platform'], get_versions, missing='Unknown')
+    df['Exit'] = df['Flag - Exit'] == 1
+    return df
+
+
+def summarise(df):
+    """Count the relays and sum their bandwidth for every combination of the group columns"""
+    with instrumentation.span('groupby'):
+        grouped = df.groupby(GROUP_COLUMNS, observed=True, dropna=False)['Bandwidth (KB/s)']
+        return grouped.agg(['count', 'sum'])
+
+
+def summarise_chunks(chunks, table=None):
+    """
+    Summarise relays that are read in chunks, the same as summarise for all of them at once.
+
+    Each chunk is folded into a running summary as it is read so only one chunk and the small
+    summary are in memory at a time, whatever the size of the export.
+    """
+    if table is None:
+        table = load_country_name_table()
+    summary = None
+    for chunk in chunks:
+        chunk_summary = summarise(add_derived_columns(chunk, table))
+        if summary is None:
+            summary = chunk_summary
+        else:
+            summary = pd.concat([summary, chunk_summary]).groupby(
+                level=GROUP_COLUMNS, observed=True, dropna=False).sum()
+    if summary is None:
+        # There were no chunks at all, the summary of no relays is empty
+        index = pd.MultiIndex.from_arrays(
+            [pd.Index([], dtype=bool if column == 'Exit' else object) for column in GROUP_COLUMNS],
+            names=GROUP_COLUMNS)
+        summary = pd.DataFrame({'count': [], 'sum': []}, index=index, dtype='int64')
+    return summary
+
+
+def datasets_from_summary(summary):
+    """Get the dictionaries needed for each chart from a summary made by summarise"""
+    def totals(frame, level):
+        return frame.groupby(level=level, observed=True).sum()
+
+    # Relays without a country are dropped by the groupby like they were before
+    per_country = totals(summary, 'Country Code')
+    exit_only = summary[summary.index.get_level_values('Exit')]
+    per_country_exit = totals(exit_only, 'Country Code')
+    per_platform = totals(summary, 'Platform Class').reindex(PLATFORM_LABELS, fill_value=0)
+    per_version = totals(summary, 'Version')
+
+    return {
+        'count_per_country': per_country['count'].to_dict(),
+        'bandwidth_per_country': per_country['sum'].to_dict(),
+        'count_per_country_exit': per_country_exit['count'].to_dict(),
+        'bandwidth_per_country_exit': per_country_exit['sum'].to_dict(),
+        'relay_number_dict': per_platform['count'].to_dict(),
+        'relay_bandwidth_dict': per_platform['sum'].to_dict(),
+        'version_count': per_version['count'].to_dict(),
+        'version_bandwidth': per_version['sum'].to_dict(),
+        }
+
+
+def aggregate(df, table=None):
+    """Get all of the data needed for the charts from the relay export with one groupby"""
+    return datasets_from_summary(summarise(add_derived_columns(df, table)))
@@ -0,0 +1,189 @@
+"""
+Benchmark each stage of making the visualisations using a synthetic relay export.
+
+Everything runs offline, the results are saved as JSON so they can be compared between commits.
+Run with --help to see the options.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from aggregation import (add_derived_columns, build_country_name_table, datasets_from_summary,
+                         map_country_names, summarise)
+from relay_data import read_relay_csv
+from render import job_name
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+PLATFORM_MIX = {'Linux': 0.8, 'FreeBSD': 0.1, 'Windows 8': 0.05, 'Darwin': 0.05}
+
+
+def synthetic_export(file_name, rows=10_000, countries=80, exit_ratio=0.15, versions=12,
+                     platform_mix=PLATFORM_MIX, seed=0):
+    """Write a relay export with the columns used by the visualisations and random values"""
+    random = np.random.default_rng(seed)
+    codes = sorted(build_country_name_table())
+    # Use made up codes if more countries are wanted than exist
+    codes += [f'X{number}' for number in range(max(0, countries - len(codes)))]
+    # A few countries have most of the relays like the real network
+    country_weights = 1/np.arange(1, countries + 1)
+    country_weights /= country_weights.sum()
+    version_names = [f'0.4.{minor}.{patch}' for minor in range(versions) for patch in (1, 2)]
+    operating_systems = list(platform_mix)
+    os_weights = np.array(list(platform_mix.values()), dtype=float)
+    platforms = [f'Tor {version} on {operating_system}' for operating_system in operating_systems
+                 for version in version_names]
+    platform_weights = np.repeat(os_weights/os_weights.sum()/len(version_names),
+                                 len(version_names))
+
+    df = pd.DataFrame({
+        'Router Name': [f'relay{number}' for number in range(rows)],
+        'Country Code': random.choice(codes[:countries], size=rows, p=country_weights),
+        'Bandwidth (KB/s)': random.integers(0, 100_000, size=rows),
+        'Uptime (Hours)': random.integers(0, 10_000, size=rows),
+        'Flag - Exit': (random.random(rows) < exit_ratio).astype(int),
+        'Flag - Fast': 1,
+        'Platform': random.choice(platforms, size=rows, p=platform_weights),
+        })
+    df.to_csv(file_name, index=False)
+
+
+def measure(function, repeat=1, trace_memory=True):
+    """
+    Time a function and find the peak memory it allocates, the fastest time is used.
+
+    Tracing memory slows the function down so it is done in an extra run that is not timed.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    measurement = {'seconds': min(times)}
+    if trace_memory:
+        tracemalloc.start()
+        function()
+        measurement['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, measurement
+
+
+def benchmark_processing(file_name, rows, repeat=1):
+    """Benchmark parsing the export, mapping the country names and aggregating"""
+    table = build_country_name_table()
+    results = {}
+    df, results['parse'] = measure(lambda: read_relay_csv(file_name), repeat)
+    _, results['name_mapping'] = measure(lambda: map_country_names(df['Country Code'], table),
+                                         repeat)
+    datasets, results['aggregation'] = measure(
+        lambda: datasets_from_summary(summarise(add_derived_columns(df.copy(), table))), repeat)
+    for stage in results.values():
+        stage['rows_per_second'] = rows/stage['seconds']
+    return datasets, results
+
+
+def benchmark_charts(datasets):
+    """Benchmark rendering each chart and saving it in each format, memory is not traced"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from make_visualisations import chart_jobs
+
+    def render_and_draw(job):
+        fig = job.function(job.data, **job.kwargs, save_names=[], show_plot=False,
+                           close_plot=False)
+        # Drawing is where most of the work happens so it is included in the render time
+        fig.canvas.draw()
+        return fig
+
+    results = {}
+    for job in chart_jobs(datasets):
+        name = job_name(job)
+        fig, render = measure(lambda: render_and_draw(job), trace_memory=False)
+        results[name] = {'render': render}
+        for save_name in job.save_names:
+            file_format = os.path.splitext(save_name)[1][1:]
+            _, results[name][f'save_{file_format}'] = measure(
+                lambda: fig.savefig(io.BytesIO(), format=file_format,
+                                    dpi=job.kwargs.get('dpi', 100)), trace_memory=False)
+        # Reused figures belong to their template and are drawn on again by the next chart
+        if not job.kwargs.get('reuse_figure'):
+            plt.close(fig)
+    return results
+
+
+def git_commit():
+    """The commit being benchmarked, None if it is not in a git repository"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Benchmark a synthetic export with the options from the command line"""
+    parser = argparse.ArgumentParser(description='Benchmark making the visualisations')
+    parser.add_argument('--rows', type=int, default=10_000, help='relays in the export')
+    parser.add_argument('--countries', type=int, default=80, help='number of countries')
+    parser.add_argument('--exit-ratio', type=float, default=0.15,
+                        help='fraction of relays that are exits')
+    parser.add_argument('--versions', type=int, default=12,
+                        help='number of distinct x.y.z tor versions')
+    parser.add_argument('--platform-mix', type=json.loads, default=PLATFORM_MIX,
+                        help='JSON object of operating system to weight, default %(default)s')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='times to repeat each processing stage, the fastest is reported')
+    parser.add_argument('--no-charts', action='store_true', help='only benchmark processing')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file to save the results to')
+    args = parser.parse_args()
+
+    parameters = {key: value for key, value in vars(args).items() if key != 'output'}
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'tor_export.csv')
+        synthetic_export(file_name, rows=args.rows, countries=args.countries,
+                         exit_ratio=args.exit_ratio, versions=args.versions,
+                         platform_mix=args.platform_mix)
+        datasets, processing = benchmark_processing(file_name, args.rows, args.repeat)
+    charts = {} if args.no_charts else benchmark_charts(datasets)
+
+    # ru_maxrss is in kilobytes on Linux
+    max_resident_memory = resource and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'parameters': parameters,
+        'processing': processing,
+        'charts': charts,
+        'max_resident_memory_kb': max_resident_memory,
+        }
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=4)
+
+    for stage, result in processing.items():
+        print(f'{stage}: {result["seconds"]:.3f} s, {result["rows_per_second"]:,.0f} rows/s, '
+              f'peak {result["peak_memory_bytes"]/2**20:.1f} MiB')
+    for name, stages in charts.items():
+        timings = ', '.join(f'{stage} {result["seconds"]:.2f} s'
+                            for stage, result in stages.items())
+        print(f'{name}: {timings}')
+    print(f'Saved the results to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
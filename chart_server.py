@@ -0,0 +1,231 @@
+"""
+Serve the charts over HTTP, rendered on demand from aggregates kept in memory.
+
+The latest relay export is aggregated once and refreshed in the background, each chart is
+rendered into memory when it is first asked for and kept in an LRU cache so repeat requests
+are served without rendering or touching the disk. Run with --help to see the options.
+
+    GET /charts                  JSON list of the chart names
+    GET /charts/<name>.png       the chart as a PNG, ?dpi= changes the resolution and
+                                 ?preview=1 gives a cheaper version for thumbnails
+    GET /charts/<name>.svg       the chart as an SVG
+    GET /status                  JSON with when the data was last refreshed and cache stats
+"""
+import argparse
+import collections
+import http.server
+import io
+import json
+import os
+import threading
+import time
+import traceback
+import urllib.parse
+
+import matplotlib
+import requests
+
+import instrumentation
+from aggregation import aggregate
+from download import download_file
+from make_visualisations import TOR_STATUS_URL, chart_jobs
+from relay_data import load_relays
+from render import job_fingerprint, job_name
+
+CONTENT_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+
+class ChartCache:
+    """A thread safe LRU cache of rendered charts, the least recently used is removed first"""
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The cached value for key or None"""
+        with self._lock:
+            if key not in self._items:
+                instrumentation.count('chart_cache_misses')
+                return None
+            instrumentation.count('chart_cache_hits')
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        """Add a value, removing the least recently used if the cache is full"""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ChartService:
+    """
+    Keeps the aggregates of the latest relay export in memory and renders charts from them.
+
+    refresh downloads the export if it has changed and aggregates it again, start_refreshing
+    does this every interval seconds in a background thread.
+    """
+
+    def __init__(self, url=TOR_STATUS_URL, file_name='tor_export.csv', cache_size=64):
+        # The charts are only ever rendered to buffers, no windows are opened
+        matplotlib.use('Agg')
+        self.url = url
+        self.file_name = file_name
+        self.cache = ChartCache(cache_size)
+        # The chart job and its fingerprint for each chart name
+        self.jobs = {}
+        self.refreshed = None
+        self._session = requests.Session()
+        self._stop = threading.Event()
+        # matplotlib is not thread safe so only one chart is rendered at a time
+        self._render_lock = threading.Lock()
+
+    def refresh(self):
+        """Download the export and, if it has changed or nothing is loaded, aggregate it"""
+        with instrumentation.span('download'):
+            changed = download_file(self.url, self.file_name, session=self._session)
+        if changed or not self.jobs:
+            with instrumentation.span('parse'):
+                df = load_relays(self.file_name)
+            with instrumentation.span('aggregate'):
+                datasets = aggregate(df)
+            # The dictionary is replaced whole so requests never see a half updated one, the
+            # fingerprint of each job is worked out once here rather than for every request
+            self.jobs = {job_name(job): (job, job_fingerprint(job))
+                         for job in chart_jobs(datasets)}
+        self.refreshed = time.time()
+
+    def _refresh_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the last data if the refresh fails, it is tried again later
+                traceback.print_exc()
+
+    def start_refreshing(self, interval=3600):
+        """Refresh the data every interval seconds in a background thread"""
+        thread = threading.Thread(target=self._refresh_loop, args=(interval,), daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stop refreshing in the background"""
+        self._stop.set()
+
+    def render(self, name, file_format='png', dpi=None, preview=False):
+        """
+        Get a chart as bytes in file_format, rendered only if it is not in the cache.
+        If preview is True the cheaper preview version of the chart is rendered.
+
+        The cache key includes the fingerprint of the chart's data and settings, so charts
+        whose data did not change in a refresh stay cached. Raises KeyError for unknown charts.
+        """
+        import matplotlib.pyplot as plt
+
+        job, fingerprint = self.jobs[name]
+        dpi = dpi or job.kwargs.get('dpi', 100)
+        key = (fingerprint, file_format, dpi, preview)
+        image = self.cache.get(key)
+        if image is None:
+            with self._render_lock, instrumentation.span(f'render {name}'):
+                fig = job.function(job.data, **dict(job.kwargs, preview=preview), save_names=[],
+                                   show_plot=False, close_plot=False)
+                buffer = io.BytesIO()
+                fig.savefig(buffer, format=file_format, dpi=dpi)
+                if not job.kwargs.get('reuse_figure'):
+                    plt.close(fig)
+            image = buffer.getvalue()
+            self.cache.put(key, image)
+        return image
+
+
+class ChartRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles the requests for the charts, the service is set on the server"""
+
+    def _send(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, value, status=200):
+        self._send(json.dumps(value, indent=4).encode(), 'application/json', status)
+
+    def do_GET(self):
+        service = self.server.service
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path).rstrip('/')
+        if path == '/charts':
+            self._send_json(sorted(service.jobs))
+        elif path == '/status':
+            self._send_json({'refreshed': service.refreshed, 'cached_charts': len(service.cache),
+                             **instrumentation.snapshot()})
+        elif path.startswith('/charts/'):
+            name, extension = os.path.splitext(path[len('/charts/'):])
+            file_format = extension[1:]
+            if name not in service.jobs or file_format not in CONTENT_TYPES:
+                self._send_json({'error': f'No chart {name}{extension}'}, 404)
+                return
+            query = urllib.parse.parse_qs(url.query)
+            preview = query.get('preview', ['0'])[0] not in ('0', 'false', '')
+            try:
+                dpi = int(query.get('dpi', [0])[0]) or None
+            except ValueError:
+                self._send_json({'error': 'dpi must be a number'}, 400)
+                return
+            if dpi is not None and not 10 <= dpi <= 600:
+                self._send_json({'error': 'dpi must be between 10 and 600'}, 400)
+                return
+            try:
+                image = service.render(name, file_format, dpi, preview)
+            except Exception:
+                traceback.print_exc()
+                self._send_json({'error': f'Failed to render {name}{extension}'}, 500)
+                return
+            self._send(image, CONTENT_TYPES[file_format])
+        else:
+            self._send_json({'error': 'Not found'}, 404)
+
+
+def serve(service, host='127.0.0.1', port=8000):
+    """Serve the charts from service until interrupted"""
+    server = http.server.ThreadingHTTPServer((host, port), ChartRequestHandler)
+    server.service = service
+    print(f'Serving the charts on http://{host}:{server.server_address[1]}/charts')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+
+
+def main():
+    """Load the latest data then serve the charts with the options from the command line"""
+    parser = argparse.ArgumentParser(description='Serve the Tor relay charts over HTTP')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--refresh', type=float, default=3600,
+                        help='seconds between checking for new data, default %(default)s')
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help='number of rendered charts to keep in memory')
+    args = parser.parse_args()
+
+    service = ChartService(cache_size=args.cache_size)
+    service.refresh()
+    service.start_refreshing(args.refresh)
+    serve(service, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
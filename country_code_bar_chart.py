@@ -1,216 +1,339 @@
-import itertools
-import io
+import functools
 import time
 
 import matplotlib.pyplot as plt
-import matplotlib as mpl
 from matplotlib import transforms
-plt.rcdefaults()
+from matplotlib.backends.backend_agg import RendererAgg
+from matplotlib.font_manager import FontProperties
+from matplotlib.patches import Patch, Rectangle
+from matplotlib.ticker import FuncFormatter
 
+import instrumentation
+from render import save_figure, use_default_style
 
-def find_renderer(fig):
-    """Find the renderer used"""
-    if hasattr(fig.canvas, "get_renderer"):
-        # Some backends, such as TkAgg, have the get_renderer method, which
-        # makes this easy.
-        renderer = fig.canvas.get_renderer()
-    else:
-        # Other backends do not have the get_renderer method, so we have a work
-        # around to find the renderer. Print the figure to a temporary file
-        # object, and then grab the renderer that was used.
-        # (I stole this trick from the matplotlib backend_bases.py
-        # print_figure() method.)
-        fig.canvas.print_pdf(io.BytesIO())
-        renderer = fig._cachedRenderer
-    return renderer
-
-
-def get_text_length(text, **kwargs):
-    """Function to get the length of a text box for the text provided."""
-    # I could not find a nice way to do this so I have to create a temp figure to render
-    # to then grab the size of the textbox.
-    plt.ioff()  # So temp figures don't flash
-    temp_fig = plt.figure()
-    renderer = mpl.backend_bases.RendererBase()
-    text_box = plt.text(0, 0, text, **kwargs)
-    text_box_dim = text_box.get_window_extent(renderer=renderer)
-    # Close the temp figure
-    plt.close(temp_fig)
-    return (text_box_dim.width, text_box_dim.height)
-
-
-def text_multiple_colours(ax, x, y, strings, colours, dpi, svg_fix, **kwargs):
-    """Show text with multiple colours, needed only in plots with normal and exit"""
-    transform = plt.gca().transData
-
-    for string, colour in zip(strings, colours):
-        text = ax.text(x, y, string+" ", color=colour, transform=transform, **kwargs)
-        text.draw(find_renderer(plt.gcf()))
-        extent = text.get_window_extent()
-        transform = transforms.offset_copy(text._transform, x=extent.width*(dpi/100)*svg_fix,
-                                           units='dots')
 
+@functools.lru_cache(maxsize=None)
+def _measuring_renderer(dpi):
+    """A renderer that is only used to measure text, one is shared for each DPI"""
+    return RendererAgg(1, 1, dpi)
 
-def country_code_plot(data, data_exit=None, title='title', xlabel='xlabel', ylabel='ylabel',
-                      figsize=(16, 12), first_color='#36B669', second_colour='#0B698C',
-                      filter_under=1, bar_height=0.75, unit_conversion=1, xlim_max=None,
-                      show_plot=True, close_plot=False, save_names=[], ytick_fontsize=12,
-                      xlabel_fontsize=20, ylabel_fontsize=20, title_fontsize=30,
-                      label_size=12, label_offset_y=0.1, label_gap=3, date_text_size=14,
-                      label_str_conversion=lambda x: x, text_scaling=1, dpi=100, svg_fix=1):
+
+@functools.lru_cache(maxsize=4096)
+def get_text_length(text, fontsize=12, weight='normal', family=None, dpi=100):
+    """
+    Get the width and height in pixels of the text when drawn at dpi.
+
+    The text is measured with a shared renderer rather than drawing it on a figure and the
+    sizes are cached as the same labels are measured many times.
+    """
+    instrumentation.count('text_measurements')
+    font = FontProperties(family=family, size=fontsize, weight=weight)
+    width, height, _ = _measuring_renderer(dpi).get_text_width_height_descent(text, font,
+                                                                               ismath=False)
+    return (width, height)
+
+
+class BarChartTemplate:
     """
-    Makes a horizontal bar chart for the data supplied, exit data is optional.
+    A styled bar chart figure that can be rendered with different data many times.
 
-    text_scaling is needed when the exit data text is being shown, the string
-    could be too long for the box so display it after the first text. If it is being displayed
-    after when it should not this is too big and if the text is overlapping this is too small.
-    Unfourtunatly I didn't find a way to get the real size of the text to be displayed so
-    get_text_length is used. text_scaling will be different on figures with different DPI.
+    The figure, axis styling, legend and footer are made once. Each render only updates the
+    existing bars and labels (adding more if there are not enough), the ticks, limits and
+    title, which is much cheaper than making a new figure for every chart.
     """
-    # Convert the data into the units you want to plot
-    data = {key: value/unit_conversion for key, value in data.items()}
-    if data_exit:
-        data_exit = {key: value/unit_conversion for key, value in data_exit.items()}
-
-    data_above_all = sorted(data.items(), key=lambda x: x[1], reverse=True)
-    # Optionally filter the results that have less than any number
-    data_above = list(filter(lambda x: x[1] >= filter_under, data_above_all))
-    data_under = list(filter(lambda x: x[1] < filter_under > 0, data_above_all))
-
-    labels_to_plot = [x[0] for x in data_above]
-    values_to_plot = [x[1] for x in data_above]
-
-    # If values are filtered out then add an other bar
-    sum_other = sum([x[1] for x in data_under])
-    if sum_other:
-        labels_to_plot.append('other ({})'.format(len(data_under)))
-        values_to_plot.append(sum_other)
-
-    # Create figure and axis for plotting
-    fig = plt.figure(figsize=figsize)
-    ax = fig.add_subplot(111)
-
-    # Plot the rectangles for both all nodes and exit nodes if applicable
-    bars_all = ax.barh(labels_to_plot, values_to_plot, align='center', height=bar_height,
-                       color=first_color, edgecolor=first_color)
-
-    if data_exit:
-        # exit_info is a list with the values in the same order as the non-exit data
-        exit_info = [data_exit.get(x[0], 0) for x in data_above]
+
+    def __init__(self, figsize=(16, 12), first_color='#36B669', second_colour='#0B698C',
+                 bar_height=0.75, ytick_fontsize=12, xlabel_fontsize=20, ylabel_fontsize=20,
+                 title_fontsize=30, date_text_size=14):
+        use_default_style()
+        self.first_color = first_color
+        self.second_colour = second_colour
+        self.bar_height = bar_height
+        self._bars_all = []
+        self._bars_exit = []
+        self._labels = []
+        self._labels_used = 0
+
+        # Create figure and axis for plotting
+        self.fig = plt.figure(figsize=figsize)
+        instrumentation.count('figures_created')
+        ax = self.ax = self.fig.add_subplot(111)
+        ax.invert_yaxis()
+        # Legend for charts with exit data, it is hidden when there is none
+        self.legend = self.fig.legend(
+            handles=[Patch(color=first_color), Patch(color=second_colour)],
+            labels=['All relays', 'Exit relays'], loc=(0.75, 0.1), fontsize=25, frameon=False)
+        # Styling section:
+        # Change legend to grey and bold
+        for text in self.legend.get_texts():
+            text.set_color('grey')
+            text.set_fontweight('bold')
+        ax.yaxis.label.set_size(ylabel_fontsize)
+        ax.xaxis.label.set_size(xlabel_fontsize)
+        ax.title.set_size(title_fontsize)
+        ax.title.set_y(1.01)
+        # Remove axis grid
+        ax.grid(False)
+        # Change splines, splines are the lines on the graph
+        ax.spines['right'].set_visible(False)
+        ax.spines['top'].set_visible(False)
+        ax.spines['left'].set_color('grey')
+        ax.spines['left'].set_linewidth(1.5)
+        ax.spines['bottom'].set_color('grey')
+        ax.spines['bottom'].set_linewidth(1.5)
+        # Remove ticks
+        ax.yaxis.set_ticks_position('left')
+        ax.xaxis.set_ticks_position('bottom')
+        # Change label axis labels and colour
+        ax.xaxis.label.set_color('grey')
+        ax.xaxis.label.set_weight('bold')
+        ax.yaxis.label.set_color('grey')
+        ax.yaxis.label.set_weight('bold')
+        # Remove y ticks and increase x tick font
+        ax.yaxis.set_tick_params(width=0, labelsize=ytick_fontsize, labelcolor='grey')
+        ax.xaxis.set_tick_params(labelsize=xlabel_fontsize)
+        # Change title
+        ax.title.set_color('grey')
+        ax.title.set_weight('bold')
+        # Change x tick to grey and put an x axis grid
+        ax.tick_params(axis='x', colors='grey')
+        ax.xaxis.grid(True, linestyle='--', which='major', color='grey', alpha=.5)
+        ax.xaxis.set_major_formatter(FuncFormatter(lambda x, _: f'{x:,.0f}'))
+        # Set figure facecolour to white
+        self.fig.patch.set_facecolor('white')
+
+        fontdict = {'fontsize': date_text_size,
+                    'fontweight': 'bold',
+                    'color': 'gray'}
+        self.footer = self.fig.text(0, 0.0002, '', fontdict=fontdict,
+                                    horizontalalignment='left')
+
+    def _update_bars(self, bars, values, colour, zorder):
+        """Set the widths of the bars to values, hiding any that are not needed"""
+        while len(bars) < len(values):
+            bar = Rectangle((0, 0), 0, self.bar_height, color=colour, zorder=zorder)
+            self.ax.add_patch(bar)
+            bars.append(bar)
+        for position, bar in enumerate(bars):
+            bar.set_visible(position < len(values))
+            if position < len(values):
+                bar.set_width(values[position])
+                bar.set_y(position - self.bar_height/2)
+
+    def _label(self, x, y, text, colour, style, transform=None):
+        """Show a label, reusing one of the label artists from a previous render if possible"""
+        if self._labels_used == len(self._labels):
+            self._labels.append(self.ax.text(0, 0, '', clip_on=True))
+        label = self._labels[self._labels_used]
+        self._labels_used += 1
+        label.set_visible(True)
+        label.set_position((x, y))
+        label.set_text(text)
+        label.set_color(colour)
+        label.set_transform(transform or self.ax.transData)
+        label.update(style)
+        return label
+
+    def _multiple_colour_label(self, x, y, strings, colours, style):
+        """Show text with multiple colours, needed only in plots with normal and exit"""
+        transform = self.ax.transData
+        for string, colour in zip(strings, colours):
+            text = self._label(x, y, string+" ", colour, style, transform)
+            # Measuring at 72 DPI gives the width in points, offsetting by points means the gap
+            # is the same whatever DPI the figure is saved at and nothing has to be drawn
+            width = get_text_length(string+" ", fontsize=style['fontsize'],
+                                    weight=style['weight'], dpi=72)[0]
+            transform = transforms.offset_copy(text.get_transform(), fig=self.fig, x=width,
+                                               units='points')
+
+    def _fit_labels_xlim(self, values, label_texts, label_gap, label_size, measure=True):
+        """
+        The smallest x axis limit where the label after every bar fits inside the axis.
+
+        A label of w pixels after a bar of value v fits if v + gap + w*xlim/width <= xlim, where
+        width is the width of the axis in pixels, so xlim >= (v + gap)/(1 - w/width). If measure
+        is False the widths of the labels are estimated from their length instead.
+        """
+        axis_width = self.ax.get_window_extent().width
+        xlim = self.ax.get_xlim()[1]
+        for value, text in zip(values, label_texts):
+            if measure:
+                text_width = get_text_length(text, fontsize=label_size, weight='bold',
+                                             dpi=self.fig.dpi)[0]
+            else:
+                # Bold characters are about 0.7 of the font size wide
+                text_width = 0.7*len(text)*label_size*self.fig.dpi/72
+            # A little extra space so the label does not touch the edge
+            fraction = min((text_width + label_size)/axis_width, 0.9)
+            xlim = max(xlim, (value + label_gap)/(1 - fraction))
+        return xlim
+
+    def render(self, data, data_exit=None, title='title', xlabel='xlabel', ylabel='ylabel',
+               filter_under=1, unit_conversion=1, xlim_max=None, label_size=12,
+               label_offset_y=0.1, label_gap=3, label_str_conversion=lambda x: x,
+               preview=False):
+        """
+        Draw the data on the chart and return the figure, exit data is optional.
+
+        When the exit data is shown and its label is too long to fit inside the exit bar it is
+        displayed after the label for all relays instead. If preview is True only the label
+        for all relays is shown, so no text has to be measured.
+        """
+        ax = self.ax
+        # Convert the data into the units you want to plot
+        data = {key: value/unit_conversion for key, value in data.items()}
+        if data_exit:
+            data_exit = {key: value/unit_conversion for key, value in data_exit.items()}
+
+        data_above_all = sorted(data.items(), key=lambda x: x[1], reverse=True)
+        # Optionally filter the results that have less than any number
+        data_above = list(filter(lambda x: x[1] >= filter_under, data_above_all))
+        data_under = list(filter(lambda x: x[1] < filter_under > 0, data_above_all))
+
+        labels_to_plot = [x[0] for x in data_above]
+        values_to_plot = [x[1] for x in data_above]
+
+        # If values are filtered out then add an other bar
+        sum_other = sum([x[1] for x in data_under])
         if sum_other:
-            exit_info.append(sum(data_exit.values())-sum(exit_info))
-        bars_exit = ax.barh(labels_to_plot, exit_info, align='center', height=bar_height,
-                            color=second_colour, edgecolor=second_colour)
-        # Add legend to the bar chart
-        legend = fig.legend(handles=[bars_all, bars_exit], labels=['All relays', 'Exit relays'],
-                            loc=(0.75, 0.1), fontsize=25, frameon=False)
-    else:
-        bars_exit = []
-
-    # Set the ytick to grey
-    ax.set_yticks(range(len(values_to_plot)))
-    ax.set_yticklabels(labels_to_plot, color='grey')
-    ax.invert_yaxis()
-
-    ax.set_ylabel(ylabel, fontsize=ylabel_fontsize)
-    ax.set_xlabel(xlabel, fontsize=xlabel_fontsize)
-    ax.set_title(title, fontsize=title_fontsize, y=1.01)
-    # Label style
-    label_style = {
-        'horizontalalignment': 'left',
-        'verticalalignment': 'center',
-        'weight': 'bold',
-        'clip_on': True,
-        'fontsize': label_size
-    }
-    # Add labels to the bars on the bar chart, zip_longest because there might be no exit data
-    for rect_all, rect_exit in itertools.zip_longest(bars_all, bars_exit):
-        # Convert float to int
-        width_all = rect_all.get_width()
-        label_text = label_str_conversion(width_all)
-        height = rect_all.get_y() + rect_all.get_height()/2 + label_offset_y
-        if not data_exit:
-            ax.text(width_all+label_gap, height, label_text, color='grey', **label_style)
+            labels_to_plot.append('other ({})'.format(len(data_under)))
+            values_to_plot.append(sum_other)
+
+        # Update the rectangles for both all nodes and exit nodes if applicable
+        self._update_bars(self._bars_all, values_to_plot, self.first_color, zorder=1)
+        if data_exit:
+            # exit_info is a list with the values in the same order as the non-exit data
+            exit_info = [data_exit.get(x[0], 0) for x in data_above]
+            if sum_other:
+                exit_info.append(sum(data_exit.values())-sum(exit_info))
         else:
-            width_exit = rect_exit.get_width()
+            exit_info = []
+        # The exit bars are always drawn on top of the bars for all relays
+        self._update_bars(self._bars_exit, exit_info, self.second_colour, zorder=1.1)
+        self.legend.set_visible(bool(data_exit))
+
+        ax.set_yticks(range(len(values_to_plot)))
+        ax.set_yticklabels(labels_to_plot)
+        # Only the text is changed, set_title would reset the styling
+        ax.yaxis.label.set_text(ylabel or '')
+        ax.xaxis.label.set_text(xlabel or '')
+        ax.title.set_text(title)
+        # Make the bars fill the y axis, the y axis is inverted so the largest is at the top
+        ax.set_ylim(len(values_to_plot) - 1 + self.bar_height/2, -self.bar_height/2)
+        # Start with 5% more than the largest bar, it is made wider to fit the labels later
+        ax.set_xlim((0, xlim_max or max(values_to_plot, default=1)*1.05))
+        self.footer.set_text(f'AceLewis.com - Date: {time.strftime("%Y-%m-%d")}')
+        # Hide the labels from the last render while the layout is worked out
+        for label in self._labels:
+            label.set_visible(False)
+        self._labels_used = 0
+        # Make the figure tight
+        self.fig.tight_layout(rect=[0.01, 0.01, 0.95, 0.99])
+
+        # Label style
+        label_style = {
+            'horizontalalignment': 'left',
+            'verticalalignment': 'center',
+            'weight': 'bold',
+            'fontsize': label_size
+        }
+        if not xlim_max:
+            label_texts = [label_str_conversion(value) for value in values_to_plot]
+            if data_exit and not preview:
+                # The longest a label can be, when the exit label is put after it
+                label_texts = [f'{text} - {label_str_conversion(value)}'
+                               for text, value in zip(label_texts, exit_info)]
+            # Previews measure no text so the widths of their labels are estimated
+            ax.set_xlim((0, self._fit_labels_xlim(values_to_plot, label_texts, label_gap,
+                                                  label_size, measure=not preview)))
+        # The labels are added once the axis limits and layout are final so that the size of
+        # the text in pixels can be converted to the data units of the bars
+        data_per_pixel = (ax.get_xlim()[1] - ax.get_xlim()[0])/ax.get_window_extent().width
+        # Add labels to the bars on the bar chart
+        for position, width_all in enumerate(values_to_plot):
+            label_text = label_str_conversion(width_all)
+            height = position + label_offset_y
+            if not data_exit or preview:
+                self._label(width_all+label_gap, height, label_text, 'grey', label_style)
+                continue
+            width_exit = exit_info[position]
             exit_label_text = label_str_conversion(width_exit)
 
-            # Get text dimensions to know when something overlaps
+            # Get text dimensions to know when something overlaps, this is the only place the
+            # labels are counted so each bar's label is counted once however it is placed
+            instrumentation.count('labels_measured')
             text_dimension_exit = get_text_length(exit_label_text, weight='bold',
-                                                  fontsize=label_size)[0]*text_scaling
+                                                  fontsize=label_size,
+                                                  dpi=self.fig.dpi)[0]*data_per_pixel
             exit_color = 'white'
             if width_exit == 0:
                 # Don't put a text box for  the exit
-                ax.text(width_all+label_gap, height, label_text, color='grey', **label_style)
+                self._label(width_all+label_gap, height, label_text, 'grey', label_style)
             elif width_all - width_exit < text_dimension_exit + label_gap:
                 # If the text will overlap with the other bar then place the text after
                 # the second bar.
                 exit_label_text = f'- {exit_label_text}'
-                text_multiple_colours(ax, width_all+label_gap, height,
-                                      [label_text, exit_label_text], ['grey', second_colour],
-                                      dpi, svg_fix, **label_style)
+                self._multiple_colour_label(width_all+label_gap, height,
+                                            [label_text, exit_label_text],
+                                            ['grey', self.second_colour], label_style)
             else:
-                ax.text(width_all+label_gap, height, label_text, color='grey', **label_style)
-                ax.text(width_exit+label_gap, height, exit_label_text, color=exit_color,
-                        **label_style)
-    # Styling section:
-    # Change legend to grey and bold if it exists
-    if 'legend' in vars():
-        for text in legend.get_texts():
-            text.set_color('grey')
-            text.set_fontweight('bold')
-    # Remove axis grid
-    ax.grid(False)
-    ylim = ax.get_ylim()
-    ax.set_ylim([ylim[0]+(1-bar_height), ylim[1]-(1-bar_height)])
-    # Change splines, splines are the lines on the graph
-    ax.spines['right'].set_visible(False)
-    ax.spines['top'].set_visible(False)
-    ax.spines['left'].set_color('grey')
-    ax.spines['left'].set_linewidth(1.5)
-    ax.spines['bottom'].set_color('grey')
-    ax.spines['bottom'].set_linewidth(1.5)
-    # Remove ticks
-    ax.yaxis.set_ticks_position('left')
-    ax.xaxis.set_ticks_position('bottom')
-    # Change label axis labels_to_plot and colour
-    ax.xaxis.label.set_color('grey')
-    ax.xaxis.label.set_weight('bold')
-    ax.yaxis.label.set_color('grey')
-    ax.yaxis.label.set_weight('bold')
-    # Remove y ticks and increase x tick font
-    ax.yaxis.set_tick_params(width=0, labelsize=ytick_fontsize)
-    ax.xaxis.set_tick_params(labelsize=xlabel_fontsize)
-    # ax.title.set_size(1)
-    # Change title
-    ax.title.set_color('grey')
-    ax.title.set_weight('bold')
-    # Change x tick to grey and put an x axis grid
-    ax.tick_params(axis='x', colors='grey')
-    ax.xaxis.grid(True, linestyle='--', which='major', color='grey', alpha=.5)
-    # Set figure facecolour to white
-    fig.patch.set_facecolor('white')
-    # Make the figure tight
-    plt.autoscale(enable=True, axis='y', tight=True)
-    plt.tight_layout(rect=[0.01, 0.01, 0.95, 0.99])
-    if xlim_max:
-        ax.set_xlim((0, xlim_max))
-    ax.set_xticklabels([f'{x:,.0f}' for x in ax.get_xticks().tolist()])
-
-    fontdict = {'fontsize': date_text_size,
-                'fontweight': 'bold',
-                'color': 'gray'}
-    date_string = time.strftime('%Y-%m-%d')
-    fig.text(0, 0.0002, f'AceLewis.com - Date: {date_string}',
-             fontdict=fontdict, horizontalalignment='left')
+                self._label(width_all+label_gap, height, label_text, 'grey', label_style)
+                self._label(width_exit+label_gap, height, exit_label_text, exit_color,
+                            label_style)
+        return self.fig
+
+    def save(self, save_names, dpi=100):
+        """Save the chart to each of the save_names"""
+        save_figure(self.fig, save_names, dpi=dpi)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_template(style):
+    """A template for each style, so they can be reused"""
+    return BarChartTemplate(**dict(style))
+
+
+def country_code_plot(data, data_exit=None, title='title', xlabel='xlabel', ylabel='ylabel',
+                      figsize=(16, 12), first_color='#36B669', second_colour='#0B698C',
+                      filter_under=1, bar_height=0.75, unit_conversion=1, xlim_max=None,
+                      show_plot=True, close_plot=False, save_names=[], ytick_fontsize=12,
+                      xlabel_fontsize=20, ylabel_fontsize=20, title_fontsize=30,
+                      label_size=12, label_offset_y=0.1, label_gap=3, date_text_size=14,
+                      label_str_conversion=lambda x: x, dpi=100, reuse_figure=False,
+                      preview=False):
+    """
+    Makes a horizontal bar chart for the data supplied and returns the figure, exit data is
+    optional.
+
+    When the exit data is shown and its label is too long to fit inside the exit bar it is
+    displayed after the label for all relays instead.
+
+    If xlim_max is not given the x axis is made just wide enough for the label of every bar.
+    If reuse_figure is True the figure is kept and reused by the next chart with the same
+    figure style, so it is never closed and must not be changed by the caller. If preview is
+    True a cheaper chart for thumbnails is made with only the label for all relays.
+    """
+    style = dict(figsize=figsize, first_color=first_color, second_colour=second_colour,
+                 bar_height=bar_height, ytick_fontsize=ytick_fontsize,
+                 xlabel_fontsize=xlabel_fontsize, ylabel_fontsize=ylabel_fontsize,
+                 title_fontsize=title_fontsize, date_text_size=date_text_size)
+    if reuse_figure:
+        # Lists, e.g. a figsize from the JSON chart specification, can not be a cache key
+        key = tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                           for name, value in style.items()))
+        template = _cached_template(key)
+    else:
+        template = BarChartTemplate(**style)
+    fig = template.render(data, data_exit=data_exit, title=title, xlabel=xlabel, ylabel=ylabel,
+                          filter_under=filter_under, unit_conversion=unit_conversion,
+                          xlim_max=xlim_max, label_size=label_size,
+                          label_offset_y=label_offset_y, label_gap=label_gap,
+                          label_str_conversion=label_str_conversion, preview=preview)
 
     # Now show the plot and save it
     if show_plot:
         plt.show()
-    for save_name in save_names:
-        plt.show()
-        # If you want to change the DPI then reduce the extent in text_multiple_colours
-        # by that same percentage. SVGs have a different issue.
-        plt.savefig(save_name, dpi=dpi)
-    if close_plot:
-        plt.close()
+    template.save(save_names, dpi=dpi)
+    if close_plot and not reuse_figure:
+        plt.close(fig)
+    return fig
@@ -3,6 +3,9 @@ import time
 import matplotlib.pyplot as plt
 import matplotlib.patheffects as PathEffects
 
+import instrumentation
+from render import save_figure, use_default_style
+
 
 def custom_autopct(pct, fff):
     """How numeric values should be displayed"""
@@ -12,8 +15,14 @@ def custom_autopct(pct, fff):
 def donut_chart(data, plot_title, colours=None, percent_thresh=0, title_font_size=25,
                 wedge_text_size=22, label_text_size=22, filter_percent=5, startangle=70,
                 pctdistance=0.8, labeldistance=1.1, wedgeprops=0.4, date_text_size=10,
-                show_plot=True, close_plot=False, save_names=[], dpi=100):
-    """Makes a donut chart"""
+                show_plot=True, close_plot=False, save_names=[], dpi=100, preview=False):
+    """
+    Makes a donut chart and returns the figure.
+
+    If preview is True a cheaper chart for thumbnails is made, the percentages are not written
+    on the wedges so there is no outlined text to draw.
+    """
+    use_default_style()
     # Sort data
     data_above_all = sorted(data.items(), key=lambda x: x[1], reverse=True)
     total_sum = sum(data.values())
@@ -34,11 +43,14 @@ def donut_chart(data, plot_title, colours=None, percent_thresh=0, title_font_siz
     my_label = [[label, f'{label} ({percent:1.1f}%)'][percent < percent_thresh]
                 for percent, label in zip(sizes_percent, labels)]
     fig, ax = plt.subplots(figsize=(8, 8))
-    wedges, labels, wedge_texts = ax.pie(sizes, colors=colours, labels=my_label,
-                                         autopct=lambda x: custom_autopct(x, percent_thresh),
-                                         startangle=startangle, pctdistance=pctdistance,
-                                         labeldistance=labeldistance,
-                                         wedgeprops={'width': wedgeprops})
+    instrumentation.count('figures_created')
+    autopct = None if preview else lambda x: custom_autopct(x, percent_thresh)
+    wedges, labels, *wedge_texts = ax.pie(sizes, colors=colours, labels=my_label,
+                                          autopct=autopct, startangle=startangle,
+                                          pctdistance=pctdistance, labeldistance=labeldistance,
+                                          wedgeprops={'width': wedgeprops})
+    # pie only returns the wedge texts when autopct is given
+    wedge_texts = wedge_texts[0] if wedge_texts else []
 
     for label in labels:
         label.set_color('gray')
@@ -57,10 +69,10 @@ def donut_chart(data, plot_title, colours=None, percent_thresh=0, title_font_siz
     fontdict = {'fontsize': title_font_size,
                 'fontweight': 'bold',
                 'color': 'gray'}
-    plt.title(plot_title, fontdict=fontdict, y=1.03)
+    ax.set_title(plot_title, fontdict=fontdict, y=1.03)
     # Equal aspect ratio ensures that pie is drawn as a circle
     ax.axis('equal')
-    plt.tight_layout()
+    fig.tight_layout()
 
     fontdict = {'fontsize': date_text_size,
                 'fontweight': 'bold',
@@ -71,8 +83,7 @@ def donut_chart(data, plot_title, colours=None, percent_thresh=0, title_font_siz
 
     if show_plot:
         plt.show()
-    for save_name in save_names:
-        plt.show()
-        plt.savefig(save_name, dpi=dpi)
+    save_figure(fig, save_names, dpi=dpi)
     if close_plot:
-        plt.close()
+        plt.close(fig)
+    return fig
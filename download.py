@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import requests
+
+# Stream the export in large chunks, it is a few MB so 1 KiB chunks make far too many writes
+CHUNK_SIZE = 1024 * 1024
+
+
+def metadata_file_name(local_filename):
+    """The file the caching headers for local_filename are stored in"""
+    return f'{local_filename}.meta.json'
+
+
+def load_metadata(local_filename):
+    """Load the caching headers saved for local_filename, empty if there are none"""
+    if not os.path.exists(local_filename):
+        return {}
+    try:
+        with open(metadata_file_name(local_filename)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_metadata(local_filename, metadata, pending=False):
+    """
+    Save the caching headers for local_filename beside it.
+
+    If pending is True they are saved to a separate file and only used once commit_metadata
+    is called.
+    """
+    file_name = metadata_file_name(local_filename) + ('.pending' if pending else '')
+    with open(file_name, 'w') as file:
+        json.dump(metadata, file, indent=4)
+
+
+def commit_metadata(local_filename):
+    """Use the caching headers saved by download_file with defer_metadata, if there are any"""
+    pending_file = metadata_file_name(local_filename) + '.pending'
+    if os.path.exists(pending_file):
+        os.replace(pending_file, metadata_file_name(local_filename))
+
+
+def current_umask():
+    """The umask of the process, it can only be read by setting it so it is set back at once"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def download_file(url, local_filename, session=None, timeout=60, defer_metadata=False):
+    """
+    Download a file to local_filename if it has changed since the last download.
+
+    The ETag and Last-Modified headers are saved beside the file and sent with the next
+    request so the server can reply 304 Not Modified. The file is streamed to a temporary
+    file which replaces local_filename once it is complete, so a failed download never leaves
+    a truncated file. Returns True if local_filename now has new data.
+
+    If defer_metadata is True the headers are only used for the next request once
+    commit_metadata is called, e.g. after the new data has been processed successfully. Until
+    then the file is reported as changed by every download.
+    """
+    session = session or requests.Session()
+    metadata = load_metadata(local_filename)
+    headers = {'Accept-Encoding': 'gzip'}
+    if metadata.get('etag'):
+        headers['If-None-Match'] = metadata['etag']
+    if metadata.get('last_modified'):
+        headers['If-Modified-Since'] = metadata['last_modified']
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+
+        directory = os.path.dirname(os.path.abspath(local_filename))
+        file_descriptor, temp_name = tempfile.mkstemp(dir=directory, suffix='.part')
+        sha256 = hashlib.sha256()
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                # iter_content decodes gzip transfer encoding
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    sha256.update(chunk)
+                    file.write(chunk)
+            # mkstemp makes the file only readable by its owner, give it the permissions
+            # open would have so the export can still be read by others
+            os.chmod(temp_name, 0o666 & ~current_umask())
+            os.replace(temp_name, local_filename)
+        except BaseException:
+            os.remove(temp_name)
+            raise
+
+        new_metadata = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': sha256.hexdigest(),
+            }
+    save_metadata(local_filename, new_metadata, pending=defer_metadata)
+    # Some servers ignore conditional requests so also check if the content is the same
+    return new_metadata['sha256'] != metadata.get('sha256')
@@ -0,0 +1,100 @@
+import datetime
+import os
+import re
+
+import pandas as pd
+
+from aggregation import GROUP_COLUMNS, load_country_name_table, summarise_chunks
+from relay_data import RELAY_COLUMNS, read_relay_csv
+
+HISTORY_COLUMNS = ['Date', 'Snapshot'] + GROUP_COLUMNS + ['count', 'sum']
+
+
+def snapshot_date(file_name):
+    """The date of a snapshot, from a YYYY-MM-DD in the file name or else its modified time"""
+    match = re.search(r'(\d{4})-?(\d{2})-?(\d{2})', os.path.basename(file_name))
+    if match:
+        try:
+            return datetime.date(*map(int, match.groups()))
+        except ValueError:
+            pass
+    return datetime.date.fromtimestamp(os.path.getmtime(file_name))
+
+
+def find_snapshots(directory):
+    """Find every relay export in a directory and its subdirectories"""
+    snapshots = []
+    for root, _, files in os.walk(directory):
+        snapshots.extend(os.path.join(root, file) for file in files
+                         if file.endswith(('.csv', '.csv.gz')))
+    return sorted(snapshots)
+
+
+def is_relay_export(file_name):
+    """Check that a file has the columns of a relay export, printing a warning if not"""
+    try:
+        columns = pd.read_csv(file_name, nrows=0).columns
+    except (OSError, ValueError, UnicodeDecodeError) as error:
+        print(f'Skipping {file_name}, it could not be read: {error}')
+        return False
+    missing = set(RELAY_COLUMNS) - set(columns)
+    if missing:
+        print(f'Skipping {file_name}, it is not a relay export as it is missing the columns '
+              f'{", ".join(sorted(missing))}')
+        return False
+    return True
+
+
+def summarise_export(file_name, chunksize=100_000, table=None):
+    """
+    Count the relays and sum their bandwidth for every group in a relay export.
+
+    The export is read in chunks of chunksize rows so exports of any size can be summarised.
+    """
+    return summarise_chunks(read_relay_csv(file_name, chunksize=chunksize), table).reset_index()
+
+
+def load_history(history_file):
+    """Load the history table, empty if it has not been made yet"""
+    if not os.path.exists(history_file):
+        return pd.DataFrame(columns=HISTORY_COLUMNS)
+    return pd.read_csv(history_file, parse_dates=['Date'])
+
+
+def update_history(directory, history_file='relay_history.csv', chunksize=100_000):
+    """
+    Add every snapshot in directory that is not in the history table yet to it.
+
+    Snapshots that have already been added are not read again, the new rows are appended to
+    the end of history_file. Files that are not relay exports, including history_file if it is
+    in directory, are skipped. Returns the full history table.
+    """
+    processed = set(load_history(history_file)['Snapshot'])
+    table = load_country_name_table()
+    for file_name in find_snapshots(directory):
+        snapshot = os.path.relpath(file_name, directory)
+        if snapshot in processed or os.path.abspath(file_name) == os.path.abspath(history_file):
+            continue
+        if not is_relay_export(file_name):
+            continue
+        summary = summarise_export(file_name, chunksize=chunksize, table=table)
+        summary.insert(0, 'Date', snapshot_date(file_name))
+        summary.insert(1, 'Snapshot', snapshot)
+        summary[HISTORY_COLUMNS].to_csv(history_file, mode='a', index=False,
+                                        header=not os.path.exists(history_file))
+        print(f'Added {snapshot} to {history_file}')
+    return load_history(history_file)
+
+
+def daily_totals(history, column, value='sum'):
+    """
+    Get the daily total of value ('count' or 'sum') for each value of column.
+
+    If there are several snapshots on one day the average of them is used, a value that is
+    missing from a snapshot counts as 0 in it. The result is a dictionary of each value of
+    column to a dictionary of date strings to the total.
+    """
+    per_snapshot = history.groupby(['Date', 'Snapshot', column])[value].sum().unstack(fill_value=0)
+    per_day = per_snapshot.groupby(level='Date').mean()
+    per_day.index = per_day.index.strftime('%Y-%m-%d')
+    return {name: series.to_dict() for name, series in per_day.items()}
@@ -0,0 +1,100 @@
+"""
+Timing spans and counters for each stage of making the visualisations.
+
+The spans and counters are kept per process, workers send theirs back to be merged with merge.
+They are changed under a lock so they can be used from several threads, e.g. by chart_server.
+"""
+import collections
+import contextlib
+import cProfile
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+_spans = collections.defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+_counters = collections.Counter()
+_extra = {}
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time the code run inside, the time of every span with the same name is added up"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            _spans[name]['calls'] += 1
+            _spans[name]['seconds'] += seconds
+
+
+def count(name, amount=1):
+    """Add amount to a counter"""
+    with _lock:
+        _counters[name] += amount
+
+
+def reset():
+    """Remove all of the spans and counters"""
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _extra.clear()
+
+
+def snapshot():
+    """Get the spans and counters so far as a dictionary that can be turned into JSON"""
+    with _lock:
+        return {
+            'spans': {name: dict(values) for name, values in _spans.items()},
+            'counters': dict(_counters),
+            **_extra,
+            }
+
+
+def merge(other):
+    """Add the spans and counters from a snapshot, e.g. from a worker process"""
+    with _lock:
+        for name, values in other['spans'].items():
+            _spans[name]['calls'] += values['calls']
+            _spans[name]['seconds'] += values['seconds']
+        _counters.update(other['counters'])
+
+
+@contextlib.contextmanager
+def capture(profile_file=None, trace_memory=False):
+    """
+    Optionally profile the code run inside with cProfile and trace its peak memory.
+
+    The profile is saved to profile_file and can be read with pstats or snakeviz. Only this
+    process is profiled, use one process to include the chart rendering.
+    """
+    profiler = cProfile.Profile() if profile_file else None
+    if trace_memory:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if trace_memory:
+            with _lock:
+                _extra['peak_traced_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def write_summary(file_name=None):
+    """Write the spans and counters as JSON to file_name, or to stdout if it is None"""
+    summary = json.dumps(snapshot(), indent=4, sort_keys=True)
+    if file_name is None:
+        print(summary, file=sys.stdout)
+    else:
+        with open(file_name, 'w') as file:
+            file.write(summary)
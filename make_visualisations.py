@@ -1,222 +1,324 @@
-import requests
-import pandas as pd
-
-import matplotlib
-import pycountry
-
-from donut_chart import donut_chart
-from country_code_bar_chart import country_code_plot
-
-
-def download_file(url, local_filename):
-    """Download a file to the local_filename"""
-    request = requests.get(url)
-    with open(local_filename, 'wb') as file:
-        for chunk in request.iter_content(chunk_size=1024):
-            if chunk:  # Filter out keep-alive new chunks
-                file.write(chunk)
-
-
-def get_version(row_number, sheet):
-    """Get first three numbers from tor version"""
-    return '.'.join(sheet.iloc[row_number]['Platform'].split(' ')[1].split('.')[:3])
-
-
-def get_name(country_code):
-    """Get the country name"""
-    redefine_country_dict = {
-        'A1': 'Anonymous',
-        'EU': 'Europe',
-        'RU': 'Russia',
-        'MD': 'Moldova',
-        'KR': 'South Korea',
-        'IR': 'Iran',
-        'GB': 'U.K.',
-        'US': 'U.S.',
-        }
-    if country_code in redefine_country_dict.keys():
-        return redefine_country_dict.get(country_code)
-    elif isinstance(country_code, str):
-        return pycountry.countries.get(alpha_2=country_code).name
-    else:
-        return country_code
+"""
+Download the latest Tor relay export and make the visualisations of it.
+
+pandas, matplotlib, pycountry and requests are slow to import so they are only imported by
+the stages that use them. Checking that the data has not changed, the most common run from
+cron, then only needs requests.
+"""
+import argparse
+import json
+import os
+import sys
+
+import instrumentation
+from render import ChartJob, job_name, load_manifest, output_path, render_jobs
+
+# There are multiple sites that track tor nodes where you can download Tor_query_EXPORT.csv
+TOR_STATUS_URL = r'https://torstatus.rueckgr.at/query_export.php/Tor_query_EXPORT.csv'
+# The dpi of each size of preview, the donut charts are 8 inches wide and the bar charts 16
+PREVIEW_DPIS = {'small': 30, 'large': 60}
+# The fingerprint of the inputs of every chart that has been saved, see render.render_jobs
+MANIFEST_FILE = 'chart_manifest.json'
+# Describes every chart, the data and options it is plotted with and the formats it is saved as
+CHART_SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'charts.json')
+
+
+def mbps_label(value):
+    """Label for a bar showing bandwidth"""
+    return f'{value:,.0f} Mbps'
+
+
+def number_label(value):
+    """Label for a bar showing a number of relays"""
+    return f'{value:,.0f}'
+
+
+# The functions that can be used to label the bars, by the name used in the chart specification
+LABEL_FORMATTERS = {'mbps_label': mbps_label, 'number_label': number_label}
+
+
+def load_chart_spec(spec_file=CHART_SPEC_FILE):
+    """Load the chart specification, see charts.json"""
+    with open(spec_file) as file:
+        return json.load(file)
+
+
+def chart_names(spec):
+    """The name of every chart in the specification, in order"""
+    return [chart['name'] for chart in spec['charts']]
+
+
+def chart_options(chart, spec, datasets):
+    """
+    The keyword arguments for the chart function of a chart in the specification.
+
+    The defaults for the chart type are used unless the chart sets them. Options that cannot be
+    written in JSON are given by name: label_str_conversion is the name of one of
+    LABEL_FORMATTERS, colours the name of a matplotlib colour map and data_exit a dataset.
+    """
+    import matplotlib.pyplot as plt
+
+    options = {**spec.get('defaults', {}).get(chart['type'], {}), **chart.get('options', {})}
+    if 'label_str_conversion' in options:
+        options['label_str_conversion'] = LABEL_FORMATTERS[options['label_str_conversion']]
+    if isinstance(options.get('colours'), str):
+        colour_map = plt.get_cmap(options['colours'])
+        options['colours'] = colour_map(range(colour_map.N))
+    if 'data_exit' in chart:
+        options['data_exit'] = datasets[chart['data_exit']]
+    return options
+
+
+def chart_save_names(chart, spec):
+    """The files a chart in the specification is saved as"""
+    directory = spec.get('directory', './images')
+    formats = chart.get('formats', spec.get('formats', ['png']))
+    return [f'{directory}/{chart["name"]}.{file_format}' for file_format in formats]
+
+
+def outputs_up_to_date(spec, previews=False, manifest_file=MANIFEST_FILE):
+    """
+    Check that every chart, and its previews if previews is True, was saved successfully by
+    the last run and still exists. This only reads the manifest so it is quick.
+    """
+    manifest = load_manifest(manifest_file)
+    save_names = []
+    for chart in spec['charts']:
+        save_names += chart_save_names(chart, spec)
+        if previews:
+            save_names += [output_path(save_name) for save_name
+                           in preview_save_names(chart['name'], spec.get('directory', './images'))]
+    return all(save_name in manifest and os.path.exists(save_name) for save_name in save_names)
+
+
+def chart_jobs(datasets, spec=None, names=None):
+    """
+    Make the list of charts to render from the datasets made by aggregate.
+
+    The charts are described by spec, by default loaded from charts.json. If names is given
+    only the charts with those names are made.
+    """
+    # Imported here as importing pyplot picks the backend, which main may have to change first
+    from donut_chart import donut_chart
+    from country_code_bar_chart import country_code_plot
+
+    chart_functions = {'donut': donut_chart, 'bar': country_code_plot}
+    spec = spec or load_chart_spec()
+    jobs = []
+    for chart in spec['charts']:
+        if names is not None and chart['name'] not in names:
+            continue
+        jobs.append(ChartJob(chart_functions[chart['type']], datasets[chart['data']],
+                             chart_options(chart, spec, datasets), chart_save_names(chart, spec)))
+    return jobs
+
+
+def preview_save_names(name, directory='./images', preview_dpis=PREVIEW_DPIS):
+    """The (file name, dpi) of each size of preview of the chart called name"""
+    return [(f'{directory}/previews/{name} {size}.png', dpi)
+            for size, dpi in preview_dpis.items()]
+
+
+def preview_chart_jobs(jobs, directory='./images', preview_dpis=PREVIEW_DPIS):
+    """
+    Make a job for each chart that renders a cheap preview of it and saves it in each size.
+
+    The previews are saved as PNGs in the previews folder of directory, the charts' directory
+    in the chart specification, as '{name} {size}.png'.
+    """
+    return [ChartJob(job.function, job.data, dict(job.kwargs, preview=True),
+                     preview_save_names(job_name(job), directory, preview_dpis))
+            for job in jobs]
+
+
+def history_chart_jobs(history):
+    """Make the list of trend charts to render from the history table made by update_history"""
+    import matplotlib.pyplot as plt
+    from history import daily_totals
+    from trend_chart import trend_line_chart
 
+    png_dpi = 300
+    colours = plt.get_cmap('tab20')(range(20))
+    jobs = []
+
+    def trend(column, value, plot_title, **kwargs):
+        jobs.append(ChartJob(trend_line_chart, daily_totals(history, column, value),
+                             dict(plot_title=plot_title, colours=colours, dpi=png_dpi, **kwargs),
+                             [f'./images/history/{plot_title}.png',
+                              f'./images/history/{plot_title}.svg']))
+
+    trend('Country Code', 'sum', "Bandwidth of Tor Relays in Each Country over Time",
+          ylabel='Bandwidth in Mbps', unit_conversion=1000/8, top=10)
+    trend('Country Code', 'count', "Number of Tor Relays in Each Country over Time",
+          ylabel='Number of Nodes', top=10)
+    trend('Platform Class', 'sum', "Bandwidth of Relays by Platform over Time",
+          ylabel='Bandwidth in Mbps', unit_conversion=1000/8)
+    trend('Platform Class', 'count', "Number of Relays by Platform over Time",
+          ylabel='Number of Nodes')
+    trend('Version', 'sum', "Bandwidth of Relays by Version over Time",
+          ylabel='Bandwidth in Mbps', unit_conversion=1000/8)
+    trend('Version', 'count', "Number of Relays by Version over Time",
+          ylabel='Number of Nodes')
+    return jobs
+
+
+def history_main(directory, force=False, processes=None, headless=False):
+    """
+    Add the archived relay exports in directory to the history and plot the trends.
+
+    Returns a list of (job, traceback) for the charts that failed to render.
+    """
+    from history import update_history
+
+    if headless:
+        use_headless_backend()
+    with instrumentation.span('update_history'):
+        history = update_history(directory, history_file='relay_history.csv')
+    if history.empty:
+        print(f'No relay exports were found in {directory}')
+        return []
+    with instrumentation.span('render_all'):
+        return render_jobs(history_chart_jobs(history), processes=processes,
+                           manifest_file=MANIFEST_FILE, force=force)
+
+
+def use_headless_backend():
+    """Use the non-interactive Agg backend, this must be done before pyplot is imported"""
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def main(force=False, processes=None, headless=False, chunksize=None, previews=False,
+         spec_file=CHART_SPEC_FILE, names=None):
+    """
+    The main function, get the data, do some processing then plot it.
+
+    Nothing is plotted if the data has not changed since the last run and every chart was
+    saved successfully by it, unless force is True. The caching headers of the download are
+    only kept once every chart has been rendered, so a failed run is retried by the next one.
+    The charts are rendered in parallel using processes processes, by default one per CPU.
+    If headless is True the non-interactive Agg backend is used so it can be run on servers.
+    If chunksize is given the export is read chunksize rows at a time rather than all at once.
+    If previews is True small previews of the charts are saved as well, see preview_chart_jobs.
+    The charts are described in spec_file, if names is given only those charts are plotted and
+    they are always plotted, even if the data has not changed. Returns a list of
+    (job, traceback) for the charts that failed.
+    """
+    import requests
+    from download import commit_metadata, download_file
 
-def main():
-    """The main function, get the data, do some processing then plot it"""
-    # There are multiple sites that track tor nodes where you can download Tor_query_EXPORT.csv
-    tor_status_url = r'https://torstatus.rueckgr.at/query_export.php/Tor_query_EXPORT.csv'
     file_name = 'tor_export.csv'
-    # You should comment out the downloading of the file if you are making lots of small changes
-    download_file(tor_status_url, file_name)
+    spec = load_chart_spec(spec_file)
+    with instrumentation.span('download'), requests.Session() as session:
+        changed = download_file(TOR_STATUS_URL, file_name, session=session,
+                                defer_metadata=True)
+    if (not changed and not force and names is None
+            and outputs_up_to_date(spec, previews, MANIFEST_FILE)):
+        print(f'{file_name} has not changed since the last run, not replotting')
+        return []
+
+    from aggregation import aggregate, datasets_from_summary, summarise_chunks
+    from relay_data import load_relays, read_relay_csv
+
+    if headless:
+        use_headless_backend()
 
     # Proccessing the data section
-    df = pd.read_csv(file_name)
-
-    for country_code in df['Country Code'].unique():
-        df['Country Code'].mask(df['Country Code'] == country_code, get_name(country_code),
-                                inplace=True)
-
-    # Group by country then find out the bandwidth and number of nodes per country
-    grouped_by_country = df.groupby('Country Code')['Bandwidth (KB/s)']
-    count_per_country = grouped_by_country.agg('count').to_dict()
-    bandwidth_per_country = grouped_by_country.sum().to_dict()
-    # Same but just for exit nodes
-    exit_only = df[(df["Flag - Exit"] == 1)]
-    grouped_by_country_exit = exit_only.groupby('Country Code')['Bandwidth (KB/s)']
-    count_per_country_exit = grouped_by_country_exit.agg('count').to_dict()
-    bandwidth_per_country_exit = grouped_by_country_exit.sum().to_dict()
-    # Get the Platform OS for each relay
-    platform_labels = ['Linux', 'BSD', 'Other']
-    linux_relays = df[df['Platform'].str.contains('(Linux|GNU)')]
-    bsd_relays = df[df['Platform'].str.contains('BSD')]
-    other_relays = df[~df['Platform'].str.contains('(Linux|GNU|BSD)')]
-    # Get total bandwidth per platform
-    linux_relay_bandwidth = linux_relays['Bandwidth (KB/s)'].sum()
-    bsd_relay_bandwidth = bsd_relays['Bandwidth (KB/s)'].sum()
-    other_relay_bandwidth = other_relays['Bandwidth (KB/s)'].sum()
-    # Convert this data to dictionaries
-    relay_numbers = list(map(len, [linux_relays, bsd_relays, other_relays]))
-    relay_bandwidth = [linux_relay_bandwidth, bsd_relay_bandwidth, other_relay_bandwidth]
-    relay_number_dict = dict(zip(platform_labels, relay_numbers))
-    relay_bandwidth_dict = dict(zip(platform_labels, relay_bandwidth))
-    # Do the same for the version numbers, versions are four numbers e.g 0.4.3.5 but I will just
-    # use the first 3 to group them together more.
-    version_count = df.groupby(by=lambda x:
-                               get_version(x, df))['Bandwidth (KB/s)'].agg('count').to_dict()
-    version_bandwidth = df.groupby(by=lambda x:
-                                   get_version(x, df))['Bandwidth (KB/s)'].sum().to_dict()
+    if chunksize:
+        # For exports too large to load at once, only one chunk is in memory at a time
+        with instrumentation.span('chunked_parse_and_aggregate'):
+            summary = summarise_chunks(read_relay_csv(file_name, chunksize=chunksize))
+            datasets = datasets_from_summary(summary)
+    else:
+        with instrumentation.span('parse'):
+            df = load_relays(file_name)
+        # Get the count and bandwidth per country, platform and version with a single groupby
+        with instrumentation.span('aggregate'):
+            datasets = aggregate(df)
 
     # Section for plotting the data
-
-    # Donut chart section
-    png_dpi = 300
-    # I found the tab20 colour tange the best but it is not perfect.
-    colours = matplotlib.cm.get_cmap('tab20')(range(20))
-
-    plot_title = "Total Number of Relays by Platform"
-    donut_chart(relay_number_dict, plot_title, colours=colours, percent_thresh=3,
-                dpi=png_dpi, close_plot=True,
-                save_names=[f'./images/{plot_title}.png', f'./images/{plot_title}.svg'])
-
-    plot_title = "Total Bandwidth of Relays by Platform"
-    donut_chart(relay_bandwidth_dict, plot_title, colours=colours, percent_thresh=3,
-                dpi=png_dpi, title_font_size=23, close_plot=True,
-                save_names=[f'./images/{plot_title}.png', f'./images/{plot_title}.svg'])
-
-    plot_title = "Total Number of Relays by Version"
-    donut_chart(version_count, plot_title, colours=colours, percent_thresh=2,
-                filter_percent=3, dpi=png_dpi, close_plot=True, startangle=0,
-                save_names=[f'./images/{plot_title}.png', f'./images/{plot_title}.svg'])
-
-    plot_title = "Total Bandwidth of Relays by Version"
-    donut_chart(version_bandwidth, plot_title, colours=colours, percent_thresh=2,
-                filter_percent=3, dpi=png_dpi, close_plot=True, startangle=0,
-                save_names=[f'./images/{plot_title}.png', f'./images/{plot_title}.svg'])
-
-    plot_title = "Total Number of Relays per Country"
-    donut_chart(count_per_country, plot_title, colours=colours,
-                percent_thresh=1, filter_percent=1.35, wedge_text_size=15, startangle=90,
-                pctdistance=0.85, wedgeprops=0.3, title_font_size=22, label_text_size=15,
-                dpi=png_dpi, close_plot=True, labeldistance=1.05,
-                save_names=[f'./images/{plot_title}.png', f'./images/{plot_title}.svg'])
-
-    plot_title = "Total Bandwidth per Country"
-    donut_chart(bandwidth_per_country, plot_title, colours=colours,
-                percent_thresh=1.2, filter_percent=1.25, wedge_text_size=15, startangle=50,
-                pctdistance=0.85, wedgeprops=0.3, dpi=png_dpi, close_plot=True,
-                label_text_size=15, labeldistance=1.05,
-                save_names=[f'./images/{plot_title}.png', f'./images/{plot_title}.svg'])
-
-    # Bar chart section
-    png_dpi = 300
-    svg_fix = 0.73
-    title = "Bandwidth of Tor Relays in Each Country"
-    title_exit = "Bandwidth of Tor Exit Relays in Each Country"
-    filter_under = 1000
-    filter_under_exit = 800
-    file_name = f'./images/{title}'
-    xlim = 175_000
-    xlim_exit = 62_000
-
-    plot_kwargs = dict(
-        label_str_conversion=lambda x: f'{x:,.0f} Mbps', ytick_fontsize=15, text_scaling=180,
-        label_gap=500, xlabel='Bandwidth in Mbps', ylabel=None,
-        label_size=12, unit_conversion=1000/8, close_plot=True
-        )
-
-    country_code_plot(bandwidth_per_country,
-                      data_exit=bandwidth_per_country_exit,
-                      title=title, filter_under=filter_under, xlim_max=xlim,
-                      **plot_kwargs, dpi=png_dpi, save_names=[f'{file_name}.png'])
-
-    country_code_plot(bandwidth_per_country,
-                      title=title, filter_under=filter_under, xlim_max=xlim,
-                      **plot_kwargs, dpi=png_dpi, save_names=[f'{file_name} No Exit.png'])
-
-    country_code_plot(bandwidth_per_country_exit,
-                      title=title_exit, filter_under=filter_under_exit, xlim_max=xlim_exit,
-                      **plot_kwargs, dpi=png_dpi, save_names=[f'{file_name} Only Exit.png'])
-
-    # There is a weird issue where the figure is saved differently if it is a PNG or a SVG when
-    # the DPI is not 100 (the default). So I have to replot to save both the SVG and PNG.
-    # For SVG the DPI obviously does not matter.
-    country_code_plot(bandwidth_per_country,
-                      data_exit=bandwidth_per_country_exit,
-                      title=title, filter_under=filter_under, xlim_max=xlim,
-                      **plot_kwargs, svg_fix=svg_fix, save_names=[f'{file_name}.svg'])
-
-    country_code_plot(bandwidth_per_country,
-                      title=title, filter_under=filter_under, xlim_max=xlim,
-                      **plot_kwargs, svg_fix=svg_fix, save_names=[f'{file_name} No Exit.svg'])
-
-    country_code_plot(bandwidth_per_country_exit,
-                      title=title_exit, filter_under=filter_under_exit, xlim_max=xlim_exit,
-                      **plot_kwargs, svg_fix=svg_fix, save_names=[f'{file_name} Only Exit.svg'])
-
-    title = "Number of Tor Relays in Each Country"
-    title_exit = "Number of Tor Exit Relays in Each Country"
-    filter_under = 20
-    filter_under_exit = 7
-    xlim = 1500
-    xlim_exit = 400
-    label_gap = 5
-    label_gap_exit = 2
-    file_name = f'./images/{title}'
-
-    plot_kwargs = dict(
-        label_str_conversion=lambda x: f'{x:,.0f}', ytick_fontsize=15, text_scaling=1.5,
-        xlabel='Number of Nodes', ylabel=None, label_size=12, close_plot=True
-        )
-
-    country_code_plot(count_per_country,
-                      data_exit=count_per_country_exit,
-                      title=title, filter_under=filter_under, xlim_max=xlim, label_gap=label_gap,
-                      **plot_kwargs, dpi=png_dpi, save_names=[f'{file_name}.png'])
-
-    country_code_plot(count_per_country,
-                      title=title, filter_under=filter_under, xlim_max=xlim, label_gap=label_gap,
-                      **plot_kwargs, dpi=png_dpi, save_names=[f'{file_name} No Exit.png'])
-
-    country_code_plot(count_per_country_exit,
-                      title=title_exit, filter_under=filter_under_exit,
-                      xlim_max=xlim_exit, label_gap=label_gap_exit,
-                      **plot_kwargs, dpi=png_dpi, save_names=[f'{file_name} Only Exit.png'])
-
-    country_code_plot(count_per_country,
-                      data_exit=count_per_country_exit,
-                      title=title, filter_under=filter_under, xlim_max=xlim, label_gap=label_gap,
-                      **plot_kwargs, svg_fix=svg_fix, save_names=[f'{file_name}.svg'])
-
-    country_code_plot(count_per_country,
-                      title=title, filter_under=filter_under, xlim_max=xlim, label_gap=label_gap,
-                      **plot_kwargs, svg_fix=svg_fix, save_names=[f'{file_name} No Exit.svg'])
-
-    country_code_plot(count_per_country_exit,
-                      title=title_exit, filter_under=filter_under_exit,
-                      xlim_max=xlim_exit, label_gap=label_gap_exit,
-                      **plot_kwargs, svg_fix=svg_fix, save_names=[f'{file_name} Only Exit.svg'])
+    # Only the charts whose data or settings have changed are rendered again
+    jobs = chart_jobs(datasets, spec, names)
+    if previews:
+        jobs += preview_chart_jobs(jobs, spec.get('directory', './images'))
+    # Charts that are asked for by name are always plotted again
+    with instrumentation.span('render_all'):
+        failures = render_jobs(jobs, processes=processes, manifest_file=MANIFEST_FILE,
+                               force=force or names is not None)
+    # If only some charts were plotted the others may still need the new data
+    if not failures and names is None:
+        commit_metadata(file_name)
+    return failures
+
+
+def parse_args(args=None):
+    """Parse the command line arguments"""
+    parser = argparse.ArgumentParser(description='Make visualisations of the Tor relays')
+    parser.add_argument('--force', action='store_true',
+                        help='plot the charts even if the data has not changed')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of processes to render the charts with, default one per CPU')
+    parser.add_argument('--headless', action='store_true',
+                        default=os.environ.get('TOR_VIS_HEADLESS', '').strip().lower()
+                        not in ('', '0', 'false', 'no'),
+                        help='never open a window, for cron jobs and servers. This can also be '
+                             'set with the TOR_VIS_HEADLESS environment variable')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='read the relay export this many rows at a time to limit the '
+                             'memory used for very large exports')
+    parser.add_argument('--previews', action='store_true',
+                        help='also save small, cheaper to render previews of the charts to '
+                             'the previews folder of the charts directory')
+    parser.add_argument('--charts-file', metavar='FILE', default=CHART_SPEC_FILE,
+                        help='JSON file describing the charts to plot, default charts.json')
+    parser.add_argument('--chart', metavar='NAME', action='append', dest='charts',
+                        help='only plot the chart called NAME, even if it is up to date. Can be '
+                             'given more than once')
+    parser.add_argument('--list-charts', action='store_true',
+                        help='list the names of the charts that can be plotted and exit')
+    parser.add_argument('--history', metavar='DIRECTORY',
+                        help='plot trends from the archived relay exports in DIRECTORY instead '
+                             'of the latest data')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='save the timing and counter summary as JSON to FILE rather than '
+                             'printing it')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run with cProfile and save the stats to FILE')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='trace the peak memory allocated with tracemalloc, this is slow')
+    arguments = parser.parse_args(args)
+
+    if arguments.charts:
+        unknown = set(arguments.charts) - set(chart_names(load_chart_spec(arguments.charts_file)))
+        if unknown:
+            parser.error(f'unknown charts: {", ".join(sorted(unknown))}, see --list-charts')
+    return arguments
+
+
+def run(arguments):
+    """
+    Run main, or history_main, with the arguments and emit the instrumentation summary.
+
+    Returns a list of (job, traceback) for the charts that failed to render.
+    """
+    if arguments.list_charts:
+        print('\n'.join(chart_names(load_chart_spec(arguments.charts_file))))
+        return []
+    instrumentation.reset()
+    with instrumentation.capture(arguments.profile, arguments.trace_memory):
+        if arguments.history:
+            failures = history_main(arguments.history, force=arguments.force,
+                                    processes=arguments.processes, headless=arguments.headless)
+        else:
+            failures = main(force=arguments.force, processes=arguments.processes,
+                            headless=arguments.headless, chunksize=arguments.chunksize,
+                            previews=arguments.previews, spec_file=arguments.charts_file,
+                            names=arguments.charts)
+    instrumentation.write_summary(arguments.metrics)
+    return failures
 
 
 if __name__ == '__main__':
-    main()
+    # Exit with an error if any chart failed so cron and other schedulers notice
+    if run(parse_args()):
+        sys.exit(1)
@@ -0,0 +1,65 @@
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:  # The cache is optional, without pyarrow the CSV is parsed every time
+    pyarrow = None
+
+# The only columns of the relay export that are used and the type they should be
+RELAY_COLUMNS = {
+    'Country Code': 'category',
+    'Bandwidth (KB/s)': 'int64',
+    'Platform': 'category',
+    'Flag - Exit': 'bool',
+    }
+
+
+def cache_file_name(file_name):
+    """The columnar cache file for a relay export"""
+    return f'{os.path.splitext(file_name)[0]}.feather'
+
+
+def read_relay_csv(file_name, **kwargs):
+    """Parse only the used columns of a relay export with their proper types"""
+    return pd.read_csv(file_name, usecols=list(RELAY_COLUMNS), dtype=RELAY_COLUMNS, **kwargs)
+
+
+def write_cache(df, file_name):
+    """Save the relays to the columnar cache for the export file_name"""
+    # Uncompressed so that reading the cache is only a copy of the columns that are needed
+    pyarrow.feather.write_feather(df, cache_file_name(file_name), compression='uncompressed')
+
+
+def read_cache(file_name):
+    """Read the relays from the columnar cache, None if it is missing or older than the export"""
+    cache_name = cache_file_name(file_name)
+    if not os.path.exists(cache_name) or \
+            os.path.getmtime(cache_name) < os.path.getmtime(file_name):
+        return None
+    try:
+        table = pyarrow.feather.read_table(cache_name, memory_map=True)
+        # Only the needed columns, in the order they were saved in
+        table = table.select([name for name in table.column_names if name in RELAY_COLUMNS])
+    except (OSError, pyarrow.ArrowException):
+        return None
+    # Each column is freed once converted so the relays are not held in memory twice
+    return table.to_pandas(self_destruct=True, split_blocks=True)
+
+
+def load_relays(file_name, use_cache=True):
+    """
+    Load the relay export, converting it to a typed columnar cache the first time.
+
+    The cache is a Feather file beside the export which is used until the export changes.
+    It is only used if pyarrow is installed, otherwise the CSV is parsed each time.
+    """
+    if pyarrow is None or not use_cache:
+        return read_relay_csv(file_name)
+    df = read_cache(file_name)
+    if df is None:
+        df = read_relay_csv(file_name)
+        write_cache(df, file_name)
+    return df
@@ -0,0 +1,161 @@
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import traceback
+
+import instrumentation
+
+# A chart to render, function is donut_chart or country_code_plot and is called with the data,
+# kwargs and save_names. The function, data and kwargs must be picklable.
+ChartJob = collections.namedtuple('ChartJob', ['function', 'data', 'kwargs', 'save_names'])
+
+
+@functools.lru_cache(maxsize=None)
+def use_default_style():
+    """
+    Reset matplotlib to its default style, once per process, so a matplotlibrc does not
+    change how the charts look. Called by each chart function before it makes a figure.
+    """
+    import matplotlib.pyplot as plt
+    plt.rcdefaults()
+
+
+def output_path(save_name):
+    """The file name of an output, which is either a file name or a (file name, dpi) pair"""
+    return save_name if isinstance(save_name, str) else save_name[0]
+
+
+def save_figure(fig, save_names, dpi=100):
+    """
+    Save the figure to each of the save_names, the format comes from the file extension.
+
+    An output can be a (file name, dpi) pair to save it at a different dpi to the others, so
+    several sizes can be saved from a single render.
+    """
+    for save_name in save_names:
+        file_name, file_dpi = (save_name, dpi) if isinstance(save_name, str) else save_name
+        with instrumentation.span(f'savefig {os.path.splitext(file_name)[1][1:]}'):
+            fig.savefig(file_name, dpi=file_dpi)
+
+
+def _init_worker():
+    """Use a non-interactive backend in the worker processes"""
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def run_job(job):
+    """Render a single chart job, returns the traceback as a string if it failed or None"""
+    name = job_name(job)
+    try:
+        for save_name in job.save_names:
+            os.makedirs(os.path.dirname(output_path(save_name)) or '.', exist_ok=True)
+        with instrumentation.span(f'render {name}'):
+            job.function(job.data, **job.kwargs, save_names=job.save_names, show_plot=False,
+                         close_plot=True)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def job_name(job):
+    """The name of a job, the file name of its first output without the extension"""
+    if not job.save_names:
+        return ''
+    return os.path.splitext(os.path.basename(output_path(job.save_names[0])))[0]
+
+
+def _run_job_in_worker(job):
+    """Render a job in a worker process, the worker's instrumentation is sent back with it"""
+    instrumentation.reset()
+    error = run_job(job)
+    return error, instrumentation.snapshot()
+
+
+def _json_default(value):
+    """Convert the values in a job that json does not know about"""
+    if callable(value):
+        return f'{value.__module__}.{value.__qualname__}'
+    if hasattr(value, 'tolist'):  # numpy arrays and numbers
+        return value.tolist()
+    raise TypeError(f'Can not fingerprint {value!r}')
+
+
+def job_fingerprint(job):
+    """A hash of the function, data, kwargs and save names of a job"""
+    description = json.dumps([job.function, job.data, job.kwargs, job.save_names],
+                             sort_keys=True, default=_json_default)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def load_manifest(manifest_file):
+    """Load the fingerprint of each saved chart, keyed by the save name"""
+    try:
+        with open(manifest_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest_file, manifest):
+    """Save the fingerprint of each saved chart"""
+    with open(manifest_file, 'w') as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+
+
+def is_up_to_date(job, fingerprint, manifest):
+    """Check if every file of a job exists and was made from the same inputs"""
+    return all(manifest.get(output_path(save_name)) == fingerprint
+               and os.path.exists(output_path(save_name)) for save_name in job.save_names)
+
+
+def render_jobs(jobs, processes=None, manifest_file=None, force=False):
+    """
+    Render the chart jobs in a pool of processes, each chart is rendered in a separate process.
+
+    processes defaults to the number of CPUs, if it is 1 the charts are rendered one after
+    another in this process. Returns a list of (job, traceback) for the jobs that failed.
+
+    If manifest_file is given the fingerprint of every rendered job is saved in it and jobs
+    whose fingerprint has not changed since they were last rendered are skipped, unless force
+    is True.
+    """
+    if manifest_file is not None:
+        manifest = load_manifest(manifest_file)
+        fingerprints = [job_fingerprint(job) for job in jobs]
+        if not force:
+            outdated = [not is_up_to_date(job, fingerprint, manifest)
+                        for job, fingerprint in zip(jobs, fingerprints)]
+            jobs = [job for job, render in zip(jobs, outdated) if render]
+            fingerprints = [fingerprint for fingerprint, render in zip(fingerprints, outdated)
+                            if render]
+        print(f'Rendering {len(jobs)} charts' + ('' if force else ' that have changed'))
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1:
+        errors = [run_job(job) for job in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                    initializer=_init_worker) as executor:
+            errors = []
+            for error, worker_instrumentation in executor.map(_run_job_in_worker, jobs):
+                errors.append(error)
+                instrumentation.merge(worker_instrumentation)
+
+    failures = [(job, error) for job, error in zip(jobs, errors) if error]
+    for job, error in failures:
+        print(f'Failed to render {", ".join(map(output_path, job.save_names))}:\n{error}')
+
+    if manifest_file is not None:
+        for job, fingerprint, error in zip(jobs, fingerprints, errors):
+            for save_name in map(output_path, job.save_names):
+                if error:
+                    manifest.pop(save_name, None)
+                else:
+                    manifest[save_name] = fingerprint
+        save_manifest(manifest_file, manifest)
+    return failures
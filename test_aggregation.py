@@ -0,0 +1,63 @@
+"""
+Tests that aggregating an export in chunks gives the same data for the charts as all at once.
+
+Run with python -m unittest test_aggregation or python -m pytest.
+"""
+import os
+import tempfile
+import unittest
+
+from aggregation import aggregate, datasets_from_summary, summarise_chunks
+from relay_data import read_relay_csv
+
+# Some of the platforms are malformed and one relay has no country
+EXPORT = """Router Name,Country Code,Bandwidth (KB/s),Uptime (Hours),Flag - Exit,Platform
+relay0,GB,100,10,1,Tor 0.4.8.1 on Linux
+relay1,DE,250,20,0,Tor 0.4.8.1 on FreeBSD
+relay2,GB,75,5,0,Tor 0.4.7.2 on Windows 8
+relay3,FR,30,1,1,weird
+relay4,DE,500,99,1,
+relay5,,60,3,0,Tor 0.4.8.1 on Linux
+relay6,US,10,7,0,Tor
+relay7,GB,40,2,1,Tor 0.4.8.1 on OpenBSD
+relay8,DE,90,8,0,Tor 0.4.7.2 on Linux
+"""
+
+COUNTRY_NAMES = {'GB': 'U.K.', 'DE': 'Germany', 'FR': 'France'}
+
+
+class ChunkedAggregationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, 'tor_export.csv')
+        with open(self.file_name, 'w') as file:
+            file.write(EXPORT)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_chunks_match_whole_export(self):
+        expected = aggregate(read_relay_csv(self.file_name), COUNTRY_NAMES)
+        for chunksize in (1, 2, 4, 100):
+            with self.subTest(chunksize=chunksize):
+                summary = summarise_chunks(read_relay_csv(self.file_name, chunksize=chunksize),
+                                           COUNTRY_NAMES)
+                self.assertEqual(datasets_from_summary(summary), expected)
+
+    def test_malformed_platforms(self):
+        datasets = aggregate(read_relay_csv(self.file_name), COUNTRY_NAMES)
+        self.assertEqual(datasets['relay_number_dict'], {'Linux': 3, 'BSD': 2, 'Other': 4})
+        self.assertEqual(datasets['version_count']['Unknown'], 3)
+
+    def test_no_relays(self):
+        with open(self.file_name, 'w') as file:
+            file.write(EXPORT.splitlines()[0] + '\n')
+        datasets = datasets_from_summary(
+            summarise_chunks(read_relay_csv(self.file_name, chunksize=2), COUNTRY_NAMES))
+        self.assertEqual(datasets['count_per_country'], {})
+        self.assertEqual(datasets['relay_number_dict'], {'Linux': 0, 'BSD': 0, 'Other': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Tests that the charts in a chart specification render, using the non-interactive backend.
+
+Run with python -m unittest test_charts or python -m pytest.
+"""
+import copy
+import os
+import tempfile
+import unittest
+
+import matplotlib
+
+from make_visualisations import chart_jobs, load_chart_spec
+from render import render_jobs
+
+DATASETS = {
+    'count_per_country': {'U.K.': 30, 'Germany': 50, 'France': 5},
+    'count_per_country_exit': {'U.K.': 10, 'Germany': 2},
+    'bandwidth_per_country': {'U.K.': 300_000, 'Germany': 900_000, 'France': 20_000},
+    'bandwidth_per_country_exit': {'U.K.': 100_000, 'Germany': 20_000},
+    'relay_number_dict': {'Linux': 70, 'BSD': 10, 'Other': 5},
+    'relay_bandwidth_dict': {'Linux': 900_000, 'BSD': 200_000, 'Other': 20_000},
+    'version_count': {'0.4.8': 60, '0.4.7': 25},
+    'version_bandwidth': {'0.4.8': 800_000, '0.4.7': 320_000},
+    }
+
+
+class ChartSpecTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        matplotlib.use('Agg')
+
+    def render_spec(self, spec):
+        """
+        Render every chart in spec to a temporary directory and return the failures, a low dpi
+        is used to keep the test quick.
+        """
+        spec = copy.deepcopy(spec)
+        for defaults in spec['defaults'].values():
+            defaults['dpi'] = 30
+        with tempfile.TemporaryDirectory() as directory:
+            spec.update(directory=directory, formats=['png'])
+            failures = render_jobs(chart_jobs(DATASETS, spec), processes=1)
+            for chart in spec['charts']:
+                self.assertTrue(os.path.exists(f'{directory}/{chart["name"]}.png'))
+        return failures
+
+    def test_default_spec(self):
+        self.assertEqual(self.render_spec(load_chart_spec()), [])
+
+    def test_figsize_from_json(self):
+        # JSON has no tuples so a figsize is a list, the reused bar chart figures must allow it
+        spec = copy.deepcopy(load_chart_spec())
+        spec['defaults']['bar']['figsize'] = [8, 6]
+        self.assertEqual(self.render_spec(spec), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
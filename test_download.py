@@ -0,0 +1,103 @@
+"""
+Tests for download.py against a stand-in HTTP server on an ephemeral port.
+
+Run with python -m unittest test_download or python -m pytest.
+"""
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+
+from download import commit_metadata, download_file, load_metadata
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the server's body with an ETag, replying 304 to a matching If-None-Match"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.honour_etag and self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        # When truncated the connection is closed part way through the promised body
+        self.send_header('Content-Length', str(len(server.body) + 100*server.truncate))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.body = b'Router Name,Country Code\nrelay,GB\n'
+        self.server.etag = '"v1"'
+        self.server.honour_etag = True
+        self.server.truncate = False
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/export.csv'
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, 'tor_export.csv')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.file_name, 'rb') as file:
+            return file.read()
+
+    def test_not_modified(self):
+        self.assertTrue(download_file(self.url, self.file_name))
+        self.assertFalse(download_file(self.url, self.file_name))
+        self.assertEqual(self.read(), self.server.body)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_same_content_is_unchanged_without_conditional_support(self):
+        self.server.honour_etag = False
+        self.assertTrue(download_file(self.url, self.file_name))
+        self.assertFalse(download_file(self.url, self.file_name))
+        self.server.body += b'relay2,DE\n'
+        self.assertTrue(download_file(self.url, self.file_name))
+        self.assertEqual(self.read(), self.server.body)
+
+    def test_interrupted_download_keeps_old_export(self):
+        old_body = self.server.body
+        self.assertTrue(download_file(self.url, self.file_name))
+        self.server.body = b'Router Name,Country Code\nnew'
+        self.server.etag = '"v2"'
+        self.server.truncate = True
+        with self.assertRaises(Exception):
+            download_file(self.url, self.file_name)
+        self.assertEqual(self.read(), old_body)
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['tor_export.csv', 'tor_export.csv.meta.json'])
+        self.assertEqual(load_metadata(self.file_name)['etag'], '"v1"')
+
+    def test_permissions_follow_umask(self):
+        umask = os.umask(0o022)
+        try:
+            self.assertTrue(download_file(self.url, self.file_name))
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.file_name).st_mode & 0o777, 0o644)
+
+    def test_deferred_metadata(self):
+        self.assertTrue(download_file(self.url, self.file_name, defer_metadata=True))
+        # Not committed so the export is downloaded again and still reported as changed
+        self.assertTrue(download_file(self.url, self.file_name, defer_metadata=True))
+        commit_metadata(self.file_name)
+        self.assertFalse(download_file(self.url, self.file_name, defer_metadata=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
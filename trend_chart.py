@@ -0,0 +1,77 @@
+import time
+
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+import pandas as pd
+
+import instrumentation
+from render import save_figure, use_default_style
+
+
+def trend_line_chart(data, plot_title, ylabel='ylabel', colours=None, top=8, unit_conversion=1,
+                     figsize=(16, 9), title_fontsize=30, ylabel_fontsize=20, tick_fontsize=15,
+                     legend_fontsize=15, line_width=2.5, date_text_size=14, show_plot=True,
+                     close_plot=False, save_names=[], dpi=100):
+    """
+    Makes a line chart of how each series has changed over time and returns the figure.
+
+    data is a dictionary of series names to a dictionary of date strings to values. Only the
+    top series with the largest latest values are shown, the rest are added together as other.
+    """
+    use_default_style()
+    df = pd.DataFrame(data).fillna(0)/unit_conversion
+    df.index = pd.to_datetime(df.index)
+    df = df.sort_index()
+    # Order the series by their latest value and put the smaller ones into an other line
+    order = df.iloc[-1].sort_values(ascending=False).index
+    df = df[order]
+    if len(order) > top:
+        other = df[order[top:]].sum(axis=1)
+        df = df[order[:top]].assign(Other=other)
+
+    fig, ax = plt.subplots(figsize=figsize)
+    instrumentation.count('figures_created')
+    for number, (name, series) in enumerate(df.items()):
+        colour = None if colours is None else colours[number % len(colours)]
+        ax.plot(series.index, series.values, label=name, color=colour, linewidth=line_width)
+
+    ax.set_title(plot_title, fontsize=title_fontsize, y=1.01)
+    ax.set_ylabel(ylabel, fontsize=ylabel_fontsize)
+    ax.set_ylim(bottom=0)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, _: f'{x:,.0f}'))
+    # Styling the same as the bar charts
+    legend = ax.legend(loc='upper left', bbox_to_anchor=(1, 1), fontsize=legend_fontsize,
+                       frameon=False)
+    for text in legend.get_texts():
+        text.set_color('grey')
+        text.set_fontweight('bold')
+    ax.spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.spines['left'].set_color('grey')
+    ax.spines['left'].set_linewidth(1.5)
+    ax.spines['bottom'].set_color('grey')
+    ax.spines['bottom'].set_linewidth(1.5)
+    ax.yaxis.label.set_color('grey')
+    ax.yaxis.label.set_weight('bold')
+    ax.title.set_color('grey')
+    ax.title.set_weight('bold')
+    ax.tick_params(colors='grey', labelsize=tick_fontsize)
+    ax.yaxis.grid(True, linestyle='--', which='major', color='grey', alpha=.5)
+    fig.autofmt_xdate()
+    fig.patch.set_facecolor('white')
+    fig.tight_layout(rect=[0.01, 0.02, 0.99, 0.99])
+
+    fontdict = {'fontsize': date_text_size,
+                'fontweight': 'bold',
+                'color': 'gray'}
+    date_string = time.strftime('%Y-%m-%d')
+    fig.text(0, 0.0002, f'AceLewis.com - Date: {date_string}',
+             fontdict=fontdict, horizontalalignment='left')
+
+    if show_plot:
+        plt.show()
+    save_figure(fig, save_names, dpi=dpi)
+    if close_plot:
+        plt.close(fig)
+    return fig